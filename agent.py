@@ -1,16 +1,52 @@
 import httpx
+import orjson
 import os.path
+import re
+import binascii
+import json
+import html
+import time
+import uuid
 import asyncio
-from datetime import datetime
-from typing import Dict, List, Any
+from collections import deque
+from urllib.parse import urlencode
+from dataclasses import dataclass
+from typing import ClassVar, Dict, List, Any, Optional, Tuple
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.errors import HttpError
+from google_auth_oauthlib.flow import InstalledAppFlow  # type: ignore[import-untyped]
+from googleapiclient.errors import HttpError  # type: ignore[import-untyped]
+
+try:
+    import pybase64 as _b64  # SIMD-accelerated decoder, falls back to the stdlib
+except ImportError:
+    import base64 as _b64  # type: ignore[no-redef]
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 CREDENTIALS_FILE = "credentials.json"
+LABELS_CACHE_FILE = "labels.json"
+PROFILE_CACHE_FILE = "profile.json"
+
+BATCH_URL = "https://gmail.googleapis.com/batch/gmail/v1"
+BATCH_SIZE = 100  # Gmail accepts at most 100 subrequests per batch
+MESSAGE_CACHE_TTL = 300  # seconds a parsed message is reused before it is fetched again
+
+# Partial-response masks: only request the parts of each resource we actually read.
+# The preview only needs Gmail's pre-decoded snippet, so message bodies are never fetched.
+MESSAGE_PARAMS: Dict[str, Any] = {
+    "format": "metadata",
+    "metadataHeaders": ["From", "Subject"],
+    "fields": "id,threadId,internalDate,labelIds,snippet,payload/headers(name,value)",
+}
+MESSAGE_LIST_FIELDS = "messages/id"
+LABEL_FIELDS = "labels(id,name,type)"
+
+B64URL_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+# Separators used by format_output
+SECTION_RULE = "=" * 60
+EMAIL_RULE = "-" * 40
 
 GMAIL_FIELDS = [
     "messageId",
@@ -23,128 +59,412 @@ GMAIL_FIELDS = [
 ]
 
 
+@dataclass(slots=True)
+class ParsedMessage:
+    """Fields extracted from a single Gmail message"""
+    messageId: str
+    threadId: str
+    messageTimestamp: str
+    labelIds: List[str]
+    sender: str
+    subject: str
+    messageText: str
+
+
+def urlsafe_b64decode(data: str) -> bytes:
+    """Decode unpadded base64url data as returned by the Gmail API"""
+    pad = -len(data) & 3
+    return _b64.urlsafe_b64decode(data + "=" * pad if pad else data)
+
+
+def is_base64url(data: str) -> bool:
+    """Check that data only contains base64url characters, without attempting a decode"""
+    # Padding is only valid as at most two trailing "=" characters, and a single
+    # character left over after the last full 4-character group cannot encode a byte
+    body = data.rstrip("=")
+    if not body or len(body) % 4 == 1 or len(data) - len(body) > 2 or not body.isascii():
+        return False
+    # translate() deletes every valid character in one C-level pass; anything left is invalid
+    return not body.encode("ascii").translate(None, B64URL_ALPHABET)
+
+
+def _civil_from_days(days: int) -> Tuple[int, int, int]:
+    """Convert days since 1970-01-01 to a (year, month, day) proleptic Gregorian date"""
+    # Howard Hinnant's civil_from_days, using eras of 400 years starting on March 1st
+    era, doe = divmod(days + 719468, 146097)
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (month <= 2), month, day
+
+
+def format_timestamp(millis: int) -> str:
+    """Format epoch milliseconds as a UTC "YYYY-MM-DD HH:MM:SS" string"""
+    days, seconds = divmod(millis // 1000, 86400)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    year, month, day = _civil_from_days(days)
+    return f"{year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}"
+
+
+def extract_text_from_payload(payload: Dict[str, Any]) -> str:
+    """Extract text content from every text/plain part of a message payload"""
+    if not payload:
+        return ""
+
+    # Walk nested multipart trees iteratively; decoding happens once on the joined bytes
+    decoded_parts: List[bytes] = []
+    stack = deque([payload])
+    while stack:
+        part = stack.pop()
+        if part.get("mimeType") == "text/plain":
+            body_data = part.get("body", {}).get("data", "")
+            if body_data and is_base64url(body_data):
+                try:
+                    decoded_parts.append(urlsafe_b64decode(body_data))
+                except binascii.Error:
+                    pass
+        elif "parts" in part:
+            # Reversed so parts are popped in document order
+            stack.extend(reversed(part["parts"]))
+
+    return b"\n".join(decoded_parts).decode('utf-8', 'replace')
+
+
+class BearerAuth(httpx.Auth):
+    """Attach the OAuth access token to every request, refreshing it once on a 401"""
+    
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._token = None
+        self._header = ""
+        self._refresh_lock = asyncio.Lock()
+    
+    def _authorization(self) -> str:
+        """Bearer header value, rebuilt only when the token changes"""
+        if self.credentials.token != self._token:
+            self._token = self.credentials.token
+            self._header = f"Bearer {self._token}"
+        return self._header
+    
+    def auth_flow(self, request: httpx.Request):
+        # Used by synchronous clients only; AsyncClient goes through async_auth_flow
+        sent_token = self.credentials.token
+        request.headers["Authorization"] = self._authorization()
+        response = yield request
+        if response.status_code == 401 and self.credentials.refresh_token:
+            if self.credentials.token == sent_token:
+                self.credentials.refresh(Request())
+            request.headers["Authorization"] = self._authorization()
+            yield request
+    
+    def async_auth_flow(self, request: httpx.Request) -> Any:
+        return _AsyncBearerAuthFlow(self, request)
+    
+    async def refresh(self, failed_token: Optional[str]) -> None:
+        """Refresh the credentials once, however many requests failed on the same token"""
+        async with self._refresh_lock:
+            # Another request may have refreshed the token while this one waited
+            if self.credentials.token == failed_token:
+                await asyncio.to_thread(self.credentials.refresh, Request())
+
+
+class _AsyncBearerAuthFlow:
+    """BearerAuth's async flow as an explicit async iterator, since mypyc cannot compile async generators"""
+    
+    def __init__(self, auth: BearerAuth, request: httpx.Request):
+        self.auth = auth
+        self.request = request
+        self.sent_token: Optional[str] = None
+        self.started = False
+        self.retried = False
+    
+    def __aiter__(self) -> "_AsyncBearerAuthFlow":
+        return self
+    
+    async def __anext__(self) -> httpx.Request:
+        if self.started:
+            raise StopAsyncIteration
+        self.started = True
+        self.sent_token = self.auth.credentials.token
+        self.request.headers["Authorization"] = self.auth._authorization()
+        return self.request
+    
+    async def asend(self, response: httpx.Response) -> httpx.Request:
+        if self.retried or response.status_code != 401 or not self.auth.credentials.refresh_token:
+            raise StopAsyncIteration
+        self.retried = True
+        await self.auth.refresh(self.sent_token)
+        self.request.headers["Authorization"] = self.auth._authorization()
+        return self.request
+    
+    async def aclose(self) -> None:
+        pass
+
+
 class AsyncGmailClient:
+    # Parsed messages shared by every client in the process:
+    # (account email, messageId) -> (cached at, record)
+    _msg_cache: ClassVar[Dict[Tuple[str, str], Tuple[float, "ParsedMessage"]]] = {}
+    
     def __init__(self, credentials):
         self.credentials = credentials
         self.base_url = "https://gmail.googleapis.com/gmail/v1"
         
-    async def _make_request(self, session: httpx.AsyncClient, endpoint: str, params: Dict = None) -> Dict:
-        """Make an authenticated request to Gmail API"""
-        headers = {"Authorization": f"Bearer {self.credentials.token}"}
+    async def _make_request(self, session: httpx.AsyncClient, endpoint: str,
+                            params: Optional[Dict[str, Any]] = None,
+                            cache_file: Optional[str] = None) -> Dict[str, Any]:
+        """Make a request to Gmail API, revalidating against an on-disk cache if given"""
+        headers: Dict[str, str] = {}
         url = f"{self.base_url}/{endpoint}"
         
+        cached = self._load_cache(cache_file) if cache_file else None
+        if cached:
+            headers["If-None-Match"] = cached["etag"]
+        
         response = await session.get(url, headers=headers, params=params or {})
+        if cached and response.status_code == 304:
+            return cached["data"]
         response.raise_for_status()
-        return response.json()
+        data = orjson.loads(response.content)
+        
+        etag = response.headers.get("ETag")
+        if cache_file and etag:
+            self._save_cache(cache_file, etag, data)
+        return data
+    
+    @staticmethod
+    def _load_cache(cache_file: str) -> Optional[Dict[str, Any]]:
+        """Load an {etag, data} cache entry, ignoring missing or corrupt files"""
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or "etag" not in cached or "data" not in cached:
+            return None
+        return cached
+    
+    @staticmethod
+    def _save_cache(cache_file: str, etag: str, data: Dict[str, Any]) -> None:
+        """Persist a response alongside its ETag for conditional requests"""
+        try:
+            with open(cache_file, "w") as f:
+                json.dump({"etag": etag, "data": data}, f)
+        except OSError:
+            pass
     
     async def get_labels(self, session: httpx.AsyncClient) -> List[Dict]:
         """Fetch user's labels"""
-        data = await self._make_request(session, "users/me/labels")
+        params = {"fields": LABEL_FIELDS}
+        data = await self._make_request(session, "users/me/labels", params, LABELS_CACHE_FILE)
         return data.get("labels", [])
     
     async def get_profile(self, session: httpx.AsyncClient) -> Dict:
         """Fetch user's profile"""
-        return await self._make_request(session, "users/me/profile")
+        return await self._make_request(session, "users/me/profile", cache_file=PROFILE_CACHE_FILE)
     
     async def get_message_list(self, session: httpx.AsyncClient, max_results: int = 10) -> List[str]:
         """Get list of message IDs"""
-        params = {"maxResults": max_results}
+        params = {"maxResults": max_results, "fields": MESSAGE_LIST_FIELDS}
         data = await self._make_request(session, "users/me/messages", params)
         messages = data.get("messages", [])
         return [msg["id"] for msg in messages]
     
     async def get_message_details(self, session: httpx.AsyncClient, message_id: str) -> Dict:
         """Get detailed message information"""
-        return await self._make_request(session, f"users/me/messages/{message_id}")
+        return await self._make_request(session, f"users/me/messages/{message_id}", MESSAGE_PARAMS)
     
-    def parse_message(self, message_data: Dict) -> Dict:
-        """Parse message data to extract required fields"""
-        def get_header_value(headers: List[Dict], name: str) -> str:
-            for header in headers:
-                if header.get("name", "").lower() == name.lower():
-                    return header.get("value", "")
-            return ""
+    async def get_messages_batch(self, session: httpx.AsyncClient, message_ids: List[str]) -> List[Dict]:
+        """Get details for up to BATCH_SIZE messages in a single multipart/mixed batch request"""
+        if len(message_ids) > BATCH_SIZE:
+            raise ValueError(f"At most {BATCH_SIZE} messages can be fetched per batch request")
+        if not message_ids:
+            return []
         
-        def extract_text_from_payload(payload: Dict) -> str:
-            """Extract text content from message payload"""
-            if not payload:
-                return ""
-            
-            # If it's a multipart message
-            if "parts" in payload:
-                text_parts = []
-                for part in payload["parts"]:
-                    if part.get("mimeType") == "text/plain":
-                        body_data = part.get("body", {}).get("data", "")
-                        if body_data:
-                            import base64
-                            try:
-                                decoded = base64.urlsafe_b64decode(body_data + "===").decode('utf-8')
-                                text_parts.append(decoded)
-                            except:
-                                pass
-                return "\n".join(text_parts)
-            
-            # If it's a simple message
-            elif payload.get("mimeType") == "text/plain":
-                body_data = payload.get("body", {}).get("data", "")
-                if body_data:
-                    import base64
-                    try:
-                        return base64.urlsafe_b64decode(body_data + "===").decode('utf-8')
-                    except:
-                        pass
-            
-            return ""
+        boundary = f"batch_{uuid.uuid4().hex}"
+        query = urlencode(MESSAGE_PARAMS, doseq=True)
+        parts = []
+        for i, message_id in enumerate(message_ids):
+            parts.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <{i}>\r\n"
+                f"\r\n"
+                f"GET /gmail/v1/users/me/messages/{message_id}?{query}\r\n"
+                f"\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        
+        # Subrequests inherit the Authorization header BearerAuth sets on the outer request
+        headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+        async with session.stream("POST", BATCH_URL, headers=headers, content="".join(parts)) as response:
+            unavailable = response.status_code >= 500
+            if not unavailable:
+                response.raise_for_status()
+                messages = await self._read_batch_response(response, len(message_ids))
         
-        headers = message_data.get("payload", {}).get("headers", [])
+        # Fall back to one request per message if the batch endpoint is unavailable
+        if unavailable:
+            return await asyncio.gather(
+                *[self.get_message_details(session, msg_id) for msg_id in message_ids]
+            )
         
-        return {
-            "messageId": message_data.get("id", ""),
-            "threadId": message_data.get("threadId", ""),
-            "messageTimestamp": datetime.fromtimestamp(
-                int(message_data.get("internalDate", "0")) / 1000
-            ).strftime("%Y-%m-%d %H:%M:%S") if message_data.get("internalDate") else "",
-            "labelIds": message_data.get("labelIds", []),
-            "sender": get_header_value(headers, "From"),
-            "subject": get_header_value(headers, "Subject"),
-            "messageText": extract_text_from_payload(message_data.get("payload", {}))[:500] + "..." if len(extract_text_from_payload(message_data.get("payload", {}))) > 500 else extract_text_from_payload(message_data.get("payload", {}))
+        # Retry failed subrequests individually so errors surface as usual
+        retry_indexes = [i for i, message in enumerate(messages) if message is None]
+        retried = dict(zip(retry_indexes, await asyncio.gather(
+            *[self.get_message_details(session, message_ids[i]) for i in retry_indexes]
+        )))
+        return [retried[i] if message is None else message for i, message in enumerate(messages)]
+    
+    @classmethod
+    async def _read_batch_response(cls, response: httpx.Response, count: int) -> List[Optional[Dict[str, Any]]]:
+        """Parse a streamed multipart/mixed batch response part by part, in request order"""
+        messages: List[Optional[Dict[str, Any]]] = [None] * count
+        match = re.search(r'boundary="?([^";]+)"?', response.headers.get("Content-Type", ""))
+        if not match:
+            return messages
+        
+        # Only the part currently arriving is buffered; finished parts are parsed immediately
+        delimiter = f"--{match.group(1)}".encode()
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            search_from = max(len(buffer) - len(delimiter) + 1, 0)
+            buffer += chunk
+            end = buffer.find(delimiter, search_from)
+            while end != -1:
+                cls._parse_batch_part(bytes(buffer[:end]), messages)
+                del buffer[:end + len(delimiter)]
+                end = buffer.find(delimiter)
+        return messages
+    
+    @staticmethod
+    def _parse_batch_part(part: bytes, messages: List[Optional[Dict[str, Any]]]) -> None:
+        """Store the message resource from one batch part at its Content-ID index"""
+        part_headers, _, http_response = part.partition(b"\r\n\r\n")
+        content_id = re.search(rb"Content-ID:\s*<response-(\d+)>", part_headers, re.IGNORECASE)
+        if not content_id:
+            return
+        
+        status_line, _, body = http_response.partition(b"\r\n\r\n")
+        status = status_line.split(b" ", 2)[1] if b" " in status_line else b""
+        index = int(content_id.group(1))
+        if status == b"200" and index < len(messages):
+            messages[index] = orjson.loads(body)
+    
+    def get_cached_messages(self, account: str, message_ids: List[str]) -> Dict[str, ParsedMessage]:
+        """Return the account's cached records younger than MESSAGE_CACHE_TTL, keyed by messageId"""
+        now = time.monotonic()
+        cached = {}
+        for message_id in message_ids:
+            entry = self._msg_cache.get((account, message_id))
+            if entry and now - entry[0] < MESSAGE_CACHE_TTL:
+                cached[message_id] = entry[1]
+        return cached
+    
+    def cache_messages(self, account: str, messages: List[ParsedMessage]) -> None:
+        """Store freshly parsed records for the account and evict expired ones"""
+        now = time.monotonic()
+        expired = [
+            key for key, (cached_at, _) in self._msg_cache.items()
+            if now - cached_at >= MESSAGE_CACHE_TTL
+        ]
+        for key in expired:
+            del self._msg_cache[key]
+        for message in messages:
+            self._msg_cache[(account, message.messageId)] = (now, message)
+    
+    def parse_message(self, message_data: Dict[str, Any]) -> ParsedMessage:
+        """Parse message data to extract required fields"""
+        # Reversed so the first occurrence of a repeated header wins
+        headers: Dict[str, str] = {
+            header.get("name", "").lower(): header.get("value", "")
+            for header in reversed(message_data.get("payload", {}).get("headers", []))
         }
+        # format=metadata responses carry no body, only Gmail's HTML-escaped snippet
+        text = extract_text_from_payload(message_data.get("payload", {})) or html.unescape(
+            message_data.get("snippet", "")
+        )
+        
+        return ParsedMessage(
+            messageId=message_data.get("id", ""),
+            threadId=message_data.get("threadId", ""),
+            messageTimestamp=format_timestamp(
+                int(message_data["internalDate"])
+            ) if message_data.get("internalDate") else "",
+            labelIds=message_data.get("labelIds", []),
+            sender=headers.get("from", ""),
+            subject=headers.get("subject", ""),
+            messageText=text[:500] + "..." if len(text) > 500 else text
+        )
+    
+    def parse_messages_batch(self, messages: List[Dict[str, Any]]) -> List[ParsedMessage]:
+        """Parse a batch of message resources, preserving their order"""
+        parse = self.parse_message
+        return [parse(message) for message in messages]
+
+
+def create_session(credentials) -> httpx.AsyncClient:
+    """Create the shared HTTP/2 client; all Gmail requests multiplex over one connection"""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        auth=BearerAuth(credentials),
+    )
 
 
-async def fetch_gmail_data_async(credentials) -> Dict[str, Any]:
+async def fetch_gmail_data_async(credentials, session: httpx.AsyncClient) -> Dict[str, Any]:
     """
     Fetch user's labels, profile, and last 10 emails concurrently
+
+    `session` is expected to authenticate requests itself (see `create_session`)
     """
     client = AsyncGmailClient(credentials)
     
-    async with httpx.AsyncClient(timeout=30.0) as session:
-        # Start all requests concurrently
-        labels_task = client.get_labels(session)
-        profile_task = client.get_profile(session)
-        message_ids_task = client.get_message_list(session, 10)
-        
-        # Wait for labels, profile, and message IDs
-        labels, profile, message_ids = await asyncio.gather(
-            labels_task, profile_task, message_ids_task
-        )
-        
-        # Fetch all message details concurrently
-        message_tasks = [
-            client.get_message_details(session, msg_id) 
-            for msg_id in message_ids
-        ]
-        
-        message_details = await asyncio.gather(*message_tasks)
-        
-        # Parse messages to required format
-        parsed_messages = [client.parse_message(msg) for msg in message_details]
-        
-        return {
-            "labels": labels,
-            "profile": profile,
-            "emails": parsed_messages
-        }
+    # Start all requests concurrently
+    labels_task = client.get_labels(session)
+    profile_task = client.get_profile(session)
+    message_ids_task = client.get_message_list(session, 10)
+    
+    # Wait for labels, profile, and message IDs
+    labels, profile, message_ids = await asyncio.gather(
+        labels_task, profile_task, message_ids_task
+    )
+    
+    # Recently parsed messages come from the cache, which is keyed by account so
+    # different credentials never share records
+    account = profile.get("emailAddress", "")
+    parsed_messages = client.get_cached_messages(account, message_ids) if account else {}
+    uncached_ids = [msg_id for msg_id in message_ids if msg_id not in parsed_messages]
+    
+    # Fetch message details in batches of BATCH_SIZE and parse each batch as soon
+    # as it arrives, while the remaining batches are still in flight
+    batch_tasks = [
+        asyncio.create_task(client.get_messages_batch(session, uncached_ids[start:start + BATCH_SIZE]))
+        for start in range(0, len(uncached_ids), BATCH_SIZE)
+    ]
+    try:
+        for next_batch in asyncio.as_completed(batch_tasks):
+            batch = client.parse_messages_batch(await next_batch)
+            if account:
+                client.cache_messages(account, batch)
+            # Batches complete in any order, so records are slotted back by ID
+            for message in batch:
+                parsed_messages[message.messageId] = message
+    finally:
+        for task in batch_tasks:
+            task.cancel()
+    
+    return {
+        "labels": labels,
+        "profile": profile,
+        "emails": [parsed_messages[msg_id] for msg_id in message_ids]
+    }
 
 
 def format_output(data: Dict[str, Any]) -> str:
@@ -153,9 +473,9 @@ def format_output(data: Dict[str, Any]) -> str:
     
     # Profile information
     profile = data["profile"]
-    output.append("=" * 60)
+    output.append(SECTION_RULE)
     output.append("USER PROFILE")
-    output.append("=" * 60)
+    output.append(SECTION_RULE)
     output.append(f"Email Address: {profile.get('emailAddress', 'N/A')}")
     output.append(f"Messages Total: {profile.get('messagesTotal', 'N/A')}")
     output.append(f"Threads Total: {profile.get('threadsTotal', 'N/A')}")
@@ -163,30 +483,34 @@ def format_output(data: Dict[str, Any]) -> str:
     output.append("")
     
     # Labels
-    output.append("=" * 60)
+    output.append(SECTION_RULE)
     output.append("LABELS")
-    output.append("=" * 60)
+    output.append(SECTION_RULE)
     for label in data["labels"]:
         label_type = label.get("type", "user")
         output.append(f"• {label['name']} ({label_type})")
     output.append("")
     
     # Emails
-    output.append("=" * 60)
+    output.append(SECTION_RULE)
     output.append("LAST 10 EMAILS")
-    output.append("=" * 60)
+    output.append(SECTION_RULE)
     
     for i, email in enumerate(data["emails"], 1):
-        output.append(f"\n📧 EMAIL #{i}")
-        output.append("-" * 40)
-        output.append(f"messageId: {email['messageId']}")
-        output.append(f"threadId: {email['threadId']}")
-        output.append(f"messageTimestamp: {email['messageTimestamp']}")
-        output.append(f"sender: {email['sender']}")
-        output.append(f"subject: {email['subject']}")
-        output.append(f"labelIds: {', '.join(email['labelIds']) if email['labelIds'] else 'None'}")
-        output.append(f"messageText: {email['messageText'][:100]}{'...' if len(email['messageText']) > 100 else ''}")
-        output.append("")
+        text = email.messageText
+        preview = text if len(text) <= 100 else text[:100] + "..."
+        labels = ", ".join(email.labelIds) if email.labelIds else "None"
+        output.append(
+            f"\n📧 EMAIL #{i}\n"
+            f"{EMAIL_RULE}\n"
+            f"messageId: {email.messageId}\n"
+            f"threadId: {email.threadId}\n"
+            f"messageTimestamp (UTC): {email.messageTimestamp}\n"
+            f"sender: {email.sender}\n"
+            f"subject: {email.subject}\n"
+            f"labelIds: {labels}\n"
+            f"messageText: {preview}\n"
+        )
     
     return "\n".join(output)
 
@@ -221,8 +545,9 @@ async def main():
         print("🚀 Fetching Gmail data asynchronously...")
         start_time = asyncio.get_event_loop().time()
         
-        # Fetch all data concurrently
-        data = await fetch_gmail_data_async(creds)
+        # Fetch all data concurrently over a single shared connection
+        async with create_session(creds) as session:
+            data = await fetch_gmail_data_async(creds, session)
         
         end_time = asyncio.get_event_loop().time()
         print(f"✅ Data fetched in {end_time - start_time:.2f} seconds")
@@ -235,5 +560,5 @@ async def main():
 
 
 if __name__ == "__main__":
-    # Install required dependency: pip install httpx
+    # Install required dependency: pip install httpx[http2]
     asyncio.run(main())
\ No newline at end of file
@@ -1,8 +1,20 @@
 import pytest
+import re
+import json
+import time
 import base64
-from datetime import datetime
+import asyncio
+import threading
+import httpx
+import agent
+from datetime import datetime, timezone
 from unittest.mock import Mock
 
+from agent import (
+    BATCH_URL, MESSAGE_CACHE_TTL, AsyncGmailClient, BearerAuth, ParsedMessage,
+    fetch_gmail_data_async, format_output, format_timestamp, is_base64url,
+)
+
 
 # Mock credentials class
 class MockCredentials:
@@ -10,66 +22,104 @@ class MockCredentials:
         self.token = token
 
 
-# Simplified AsyncGmailClient for testing
-class AsyncGmailClient:
-    def __init__(self, credentials):
-        self.credentials = credentials
-        self.base_url = "https://gmail.googleapis.com/gmail/v1"
-    
-    def parse_message(self, message_data: dict) -> dict:
-        """Parse message data to extract required fields"""
-        def get_header_value(headers: list, name: str) -> str:
-            for header in headers:
-                if header.get("name", "").lower() == name.lower():
-                    return header.get("value", "")
-            return ""
-        
-        def extract_text_from_payload(payload: dict) -> str:
-            """Extract text content from message payload"""
-            if not payload:
-                return ""
-            
-            # If it's a multipart message
-            if "parts" in payload:
-                text_parts = []
-                for part in payload["parts"]:
-                    if part.get("mimeType") == "text/plain":
-                        body_data = part.get("body", {}).get("data", "")
-                        if body_data:
-                            try:
-                                decoded = base64.urlsafe_b64decode(body_data + "===").decode('utf-8')
-                                text_parts.append(decoded)
-                            except:
-                                pass
-                return "\n".join(text_parts)
-            
-            # If it's a simple message
-            elif payload.get("mimeType") == "text/plain":
-                body_data = payload.get("body", {}).get("data", "")
-                if body_data:
-                    try:
-                        return base64.urlsafe_b64decode(body_data + "===").decode('utf-8')
-                    except:
-                        pass
-            
-            return ""
-        
-        headers = message_data.get("payload", {}).get("headers", [])
-        
+def batch_response(messages, statuses=None, boundary="batch_response_boundary"):
+    """Build a multipart/mixed Gmail batch response for the given message resources"""
+    statuses = statuses or {}
+    body = ""
+    for i, message in enumerate(messages):
+        status = statuses.get(i, "200 OK")
+        body += (
+            f"--{boundary}\r\n"
+            f"Content-Type: application/http\r\n"
+            f"Content-ID: <response-{i}>\r\n"
+            f"\r\n"
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: application/json; charset=UTF-8\r\n"
+            f"\r\n"
+            f"{json.dumps(message)}\r\n"
+        )
+    body += f"--{boundary}--\r\n"
+    headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+    return headers, body.encode()
+
+
+def batch_message_ids(request):
+    """Message IDs requested by the subrequests of a batch request, in order"""
+    return re.findall(r"GET /gmail/v1/users/me/messages/([^?\s]+)", request.content.decode())
+
+
+class FakeGmail:
+    """Minimal Gmail API serving labels, profile, the message list and message details
+    
+    IDs in `missing` fail inside batch responses but can still be fetched individually;
+    IDs in `deleted` return 404 both ways, like a message removed after it was listed.
+    """
+    
+    def __init__(self, message_ids, email="me@example.com", missing=(), deleted=()):
+        self.message_ids = message_ids
+        self.email = email
+        self.missing = set(missing) | set(deleted)
+        self.deleted = set(deleted)
+        self.batches = []
+        self.singles = []
+    
+    def message(self, message_id):
         return {
-            "messageId": message_data.get("id", ""),
-            "threadId": message_data.get("threadId", ""),
-            "messageTimestamp": datetime.fromtimestamp(
-                int(message_data.get("internalDate", "0")) / 1000
-            ).strftime("%Y-%m-%d %H:%M:%S") if message_data.get("internalDate") else "",
-            "labelIds": message_data.get("labelIds", []),
-            "sender": get_header_value(headers, "From"),
-            "subject": get_header_value(headers, "Subject"),
-            "messageText": extract_text_from_payload(message_data.get("payload", {}))[:500] + "..." if len(extract_text_from_payload(message_data.get("payload", {}))) > 500 else extract_text_from_payload(message_data.get("payload", {}))
+            "id": message_id,
+            "threadId": f"thread_{message_id}",
+            "snippet": f"snippet {message_id}",
+            "payload": {"headers": [{"name": "Subject", "value": f"Subject {message_id}"}]},
         }
+    
+    def __call__(self, request):
+        path = request.url.path
+        if str(request.url) == BATCH_URL:
+            ids = batch_message_ids(request)
+            self.batches.append(ids)
+            statuses = {i: "404 Not Found" for i, message_id in enumerate(ids) if message_id in self.missing}
+            headers, body = batch_response([self.message(message_id) for message_id in ids], statuses)
+            return httpx.Response(200, headers=headers, content=body)
+        if path.endswith("/labels"):
+            return httpx.Response(200, json={"labels": [{"id": "INBOX", "name": "INBOX", "type": "system"}]})
+        if path.endswith("/profile"):
+            return httpx.Response(200, json={"emailAddress": self.email})
+        if path.endswith("/messages"):
+            return httpx.Response(200, json={"messages": [{"id": message_id} for message_id in self.message_ids]})
+        message_id = path.rsplit("/", 1)[-1]
+        if message_id in self.message_ids and message_id not in self.deleted:
+            self.singles.append(message_id)
+            return httpx.Response(200, json=self.message(message_id))
+        return httpx.Response(404)
+
+
+def cached_record(message_id):
+    """A parsed message that can only have come from the message cache"""
+    return ParsedMessage(message_id, "from_cache", "", [], "", "", "")
+
+
+class ChunkedStream(httpx.AsyncByteStream):
+    """Response body delivered in fixed-size chunks, like a slow network read"""
+    
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+    
+    async def __aiter__(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
 
 
 # Test fixtures
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    """Keep the on-disk and in-process caches from leaking between tests"""
+    monkeypatch.setattr(agent, "LABELS_CACHE_FILE", str(tmp_path / "labels.json"))
+    monkeypatch.setattr(agent, "PROFILE_CACHE_FILE", str(tmp_path / "profile.json"))
+    AsyncGmailClient._msg_cache.clear()
+    yield
+    AsyncGmailClient._msg_cache.clear()
+
+
 @pytest.fixture
 def mock_credentials():
     return MockCredentials("test_access_token")
@@ -121,6 +171,24 @@ def incomplete_message_payload():
     }
 
 
+@pytest.fixture
+def metadata_message_payload():
+    """Message fetched with format=metadata: headers and snippet, no body"""
+    return {
+        "id": "msg_metadata_24680",
+        "threadId": "thread_metadata_13579",
+        "internalDate": "1672531200000",
+        "labelIds": ["INBOX"],
+        "snippet": "Don&#39;t forget the meeting &amp; agenda",
+        "payload": {
+            "headers": [
+                {"name": "From", "value": "meta.sender@example.com"},
+                {"name": "Subject", "value": "Metadata Only"}
+            ]
+        }
+    }
+
+
 class TestGmailMessageParsing:
     """Test Gmail message parsing for two main scenarios"""
     
@@ -135,30 +203,30 @@ class TestGmailMessageParsing:
         result = client.parse_message(complete_message_payload)
         
         # Verify all required fields are properly extracted
-        assert result["messageId"] == "msg_complete_12345"
-        assert result["threadId"] == "thread_complete_67890"
+        assert result.messageId == "msg_complete_12345"
+        assert result.threadId == "thread_complete_67890"
         
-        # Timestamp should be properly formatted (timezone-aware)
-        assert result["messageTimestamp"].startswith("2023-01-01")
-        assert len(result["messageTimestamp"]) == 19  # YYYY-MM-DD HH:MM:SS format
+        # Timestamp should be properly formatted (UTC)
+        assert result.messageTimestamp == "2023-01-01 00:00:00"
+        assert len(result.messageTimestamp) == 19  # YYYY-MM-DD HH:MM:SS format
         
         # Labels should be preserved as a list
-        assert result["labelIds"] == ["INBOX", "IMPORTANT", "CATEGORY_PERSONAL"]
-        assert len(result["labelIds"]) == 3
+        assert result.labelIds == ["INBOX", "IMPORTANT", "CATEGORY_PERSONAL"]
+        assert len(result.labelIds) == 3
         
         # Headers should be correctly extracted
-        assert result["sender"] == "john.doe@example.com"
-        assert result["subject"] == "Complete Test Email Subject"
+        assert result.sender == "john.doe@example.com"
+        assert result.subject == "Complete Test Email Subject"
         
         # Message text should be decoded from base64
         expected_text = "Hello, this is a test email with complete information including sender, subject, timestamp, and labels."
-        assert result["messageText"] == expected_text
+        assert result.messageText == expected_text
         
         # Verify no fields are empty when data is available
-        assert all(field != "" for field in [result["messageId"], result["threadId"], 
-                                           result["messageTimestamp"], result["sender"], 
-                                           result["subject"], result["messageText"]])
-        assert len(result["labelIds"]) > 0
+        assert all(field != "" for field in [result.messageId, result.threadId, 
+                                           result.messageTimestamp, result.sender, 
+                                           result.subject, result.messageText])
+        assert len(result.labelIds) > 0
     
     def test_incomplete_payload_parsing(self, mock_credentials, incomplete_message_payload):
         """
@@ -171,35 +239,570 @@ class TestGmailMessageParsing:
         result = client.parse_message(incomplete_message_payload)
         
         # Required fields that are present should be correctly parsed
-        assert result["messageId"] == "msg_incomplete_98765"
-        assert result["threadId"] == "thread_incomplete_54321"
-        assert result["sender"] == "incomplete.sender@example.com"
+        assert result.messageId == "msg_incomplete_98765"
+        assert result.threadId == "thread_incomplete_54321"
+        assert result.sender == "incomplete.sender@example.com"
         
         # Missing optional fields should have appropriate defaults
-        assert result["messageTimestamp"] == ""  # Missing internalDate -> empty string
-        assert result["labelIds"] == []          # Missing labelIds -> empty list
-        assert result["subject"] == ""           # Missing Subject header -> empty string  
-        assert result["messageText"] == ""       # Missing body content -> empty string
+        assert result.messageTimestamp == ""  # Missing internalDate -> empty string
+        assert result.labelIds == []          # Missing labelIds -> empty list
+        assert result.subject == ""           # Missing Subject header -> empty string  
+        assert result.messageText == ""       # Missing body content -> empty string
         
         # Verify the structure is still valid
-        assert isinstance(result["messageId"], str)
-        assert isinstance(result["threadId"], str)
-        assert isinstance(result["messageTimestamp"], str)
-        assert isinstance(result["labelIds"], list)
-        assert isinstance(result["sender"], str)
-        assert isinstance(result["subject"], str)
-        assert isinstance(result["messageText"], str)
+        assert isinstance(result.messageId, str)
+        assert isinstance(result.threadId, str)
+        assert isinstance(result.messageTimestamp, str)
+        assert isinstance(result.labelIds, list)
+        assert isinstance(result.sender, str)
+        assert isinstance(result.subject, str)
+        assert isinstance(result.messageText, str)
         
         # Verify that present fields are not empty
-        assert result["messageId"] != ""
-        assert result["threadId"] != ""
-        assert result["sender"] != ""
+        assert result.messageId != ""
+        assert result.threadId != ""
+        assert result.sender != ""
         
         # Verify that missing fields are properly defaulted
-        assert result["messageTimestamp"] == ""
-        assert result["labelIds"] == []
-        assert result["subject"] == ""
-        assert result["messageText"] == ""
+        assert result.messageTimestamp == ""
+        assert result.labelIds == []
+        assert result.subject == ""
+        assert result.messageText == ""
+    
+    def test_batch_parsing_preserves_order(self, mock_credentials, complete_message_payload,
+                                           incomplete_message_payload):
+        """
+        Test Case 3: Parsing a batch of messages
+        
+        This test verifies that batch parsing yields the same records as parsing each
+        message individually, in the order the messages were given.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        messages = [incomplete_message_payload, complete_message_payload]
+        results = client.parse_messages_batch(messages)
+        
+        assert [r.messageId for r in results] == ["msg_incomplete_98765", "msg_complete_12345"]
+        assert results == [client.parse_message(m) for m in messages]
+        assert client.parse_messages_batch([]) == []
+    
+    def test_metadata_payload_uses_snippet(self, mock_credentials, metadata_message_payload):
+        """
+        Test Case 4: Payload fetched with format=metadata
+        
+        This test verifies that when no body is present, the message text falls back
+        to Gmail's snippet with HTML entities unescaped.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        result = client.parse_message(metadata_message_payload)
+        
+        assert result.sender == "meta.sender@example.com"
+        assert result.subject == "Metadata Only"
+        assert result.messageText == "Don't forget the meeting & agenda"
+    
+    def test_malformed_body_is_skipped(self, mock_credentials):
+        """
+        Test Case 5: Payload with malformed body data
+        
+        This test verifies that bodies which are not valid base64url are skipped instead
+        of raising, and that invalid UTF-8 is replaced rather than dropped.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        for body_data in ["not base64!", "héllo", "abcde", "ab=cd", "YQ=YQ", "YQ===", "=", "===="]:
+            message = {"id": "msg_bad", "payload": {"mimeType": "text/plain", "body": {"data": body_data}}}
+            assert client.parse_message(message).messageText == ""
+            # Rejected up front, without relying on the decoder raising
+            assert not is_base64url(body_data)
+        
+        bad_utf8 = base64.urlsafe_b64encode(b"ok \xff").decode("ascii")
+        message = {"id": "msg_bad", "payload": {"mimeType": "text/plain", "body": {"data": bad_utf8}}}
+        assert client.parse_message(message).messageText == "ok \ufffd"
+        
+        assert is_base64url("SGVsbG8td29ybGRf")
+        assert not is_base64url("SGVsbG8+d29ybGQ/")
+        assert is_base64url("YQ==") and is_base64url("YWI=") and is_base64url("YQ")
+        assert not is_base64url("ab=cd")
+        assert not is_base64url("YQ=YQ")
+        assert not is_base64url("YQ===")
+    
+    def test_nested_multipart_payload(self, mock_credentials):
+        """
+        Test Case 6: Nested multipart payload
+        
+        This test verifies that text/plain parts nested inside multipart/alternative
+        and multipart/mixed are all found and joined in document order.
+        """
+        def text_part(text):
+            encoded = base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+            return {"mimeType": "text/plain", "body": {"data": encoded}}
+        
+        message = {
+            "id": "msg_nested",
+            "payload": {
+                "mimeType": "multipart/mixed",
+                "parts": [
+                    {
+                        "mimeType": "multipart/alternative",
+                        "parts": [
+                            text_part("First part"),
+                            {"mimeType": "text/html", "body": {"data": "PGI-aGk8L2I-"}},
+                        ],
+                    },
+                    text_part("Second part ✓"),
+                    {"mimeType": "application/pdf", "body": {"attachmentId": "att_1"}},
+                ],
+            },
+        }
+        client = AsyncGmailClient(mock_credentials)
+        assert client.parse_message(message).messageText == "First part\nSecond part ✓"
+    
+    def test_timestamp_formatting_matches_datetime(self):
+        """
+        Test Case 7: Integer timestamp formatting
+        
+        This test verifies that the integer civil-from-days conversion agrees with
+        datetime across leap days, century boundaries and pre-epoch dates.
+        """
+        samples = [0, 951782400000, 951868799999, 4107542400000, 1709164800123, -1, -86400001]
+        samples += list(range(-10**13, 10**13, 7 * 10**10 + 12345))
+        for millis in samples:
+            expected = datetime.fromtimestamp(millis // 1000, tz=timezone.utc)
+            assert format_timestamp(millis) == expected.strftime("%Y-%m-%d %H:%M:%S")
+
+    
+    def test_output_labels_timestamp_as_utc(self, mock_credentials, complete_message_payload):
+        """
+        Test Case 8: Formatted output
+        
+        This test verifies that the rendered email block marks the timestamp as UTC.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        data = {
+            "profile": {"emailAddress": "me@example.com"},
+            "labels": [{"name": "INBOX", "type": "system"}],
+            "emails": [client.parse_message(complete_message_payload)],
+        }
+        output = format_output(data)
+        
+        assert "messageTimestamp (UTC): 2023-01-01 00:00:00" in output
+        assert "• INBOX (system)" in output
+
+
+class TestGmailBatchFetching:
+    """Test fetching message details through Gmail's batch endpoint"""
+    
+    @pytest.mark.asyncio
+    async def test_batch_request_and_response(self, mock_credentials):
+        """
+        Test Case 1: Successful batch request
+        
+        This test verifies the multipart/mixed request body and that responses are
+        mapped back to request order through their Content-ID.
+        """
+        requests = []
+        
+        def handler(request):
+            requests.append(request)
+            ids = batch_message_ids(request)
+            headers, body = batch_response([{"id": message_id} for message_id in ids])
+            # Answer in reverse order; Content-ID decides the position
+            parts = body.split(b"--batch_response_boundary")
+            body = b"--batch_response_boundary".join([parts[0]] + parts[-2:0:-1] + [parts[-1]])
+            return httpx.Response(200, headers=headers, content=body)
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            messages = await client.get_messages_batch(session, ["a1", "b2", "c3"])
+        
+        assert messages == [{"id": "a1"}, {"id": "b2"}, {"id": "c3"}]
+        assert len(requests) == 1
+        request = requests[0]
+        assert request.method == "POST" and str(request.url) == BATCH_URL
+        boundary = re.search(r"boundary=(\S+)", request.headers["Content-Type"]).group(1)
+        body = request.content.decode()
+        assert body.count(f"--{boundary}\r\nContent-Type: application/http\r\n") == 3
+        assert body.endswith(f"--{boundary}--\r\n")
+        assert "Content-ID: <0>" in body and "Content-ID: <2>" in body
+        assert "GET /gmail/v1/users/me/messages/b2?format=metadata&metadataHeaders=From" in body
+    
+    @pytest.mark.asyncio
+    async def test_failed_subrequest_is_retried(self, mock_credentials):
+        """
+        Test Case 2: A subrequest fails inside a successful batch
+        
+        This test verifies that a non-200 part is fetched again with a single request.
+        """
+        single_requests = []
+        
+        def handler(request):
+            if str(request.url) == BATCH_URL:
+                ids = batch_message_ids(request)
+                headers, body = batch_response(
+                    [{"id": message_id} for message_id in ids], statuses={1: "404 Not Found"}
+                )
+                return httpx.Response(200, headers=headers, content=body)
+            single_requests.append(request.url.path)
+            return httpx.Response(200, json={"id": request.url.path.rsplit("/", 1)[-1], "retried": True})
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            messages = await client.get_messages_batch(session, ["a1", "b2", "c3"])
+        
+        assert messages == [{"id": "a1"}, {"id": "b2", "retried": True}, {"id": "c3"}]
+        assert single_requests == ["/gmail/v1/users/me/messages/b2"]
+    
+    @pytest.mark.asyncio
+    async def test_batch_server_error_falls_back(self, mock_credentials):
+        """
+        Test Case 3: The batch endpoint returns a server error
+        
+        This test verifies that every message is fetched individually instead.
+        """
+        def handler(request):
+            if str(request.url) == BATCH_URL:
+                return httpx.Response(503)
+            return httpx.Response(200, json={"id": request.url.path.rsplit("/", 1)[-1]})
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            messages = await client.get_messages_batch(session, ["a1", "b2"])
+        
+        assert messages == [{"id": "a1"}, {"id": "b2"}]
+    
+    @pytest.mark.asyncio
+    async def test_response_without_boundary(self, mock_credentials):
+        """
+        Test Case 4: Batch response without a multipart boundary
+        
+        This test verifies that an unparseable batch response falls back to
+        individual requests rather than returning missing messages.
+        """
+        def handler(request):
+            if str(request.url) == BATCH_URL:
+                return httpx.Response(200, headers={"Content-Type": "multipart/mixed"}, content=b"garbage")
+            return httpx.Response(200, json={"id": request.url.path.rsplit("/", 1)[-1]})
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            messages = await client.get_messages_batch(session, ["a1", "b2"])
+        
+        assert messages == [{"id": "a1"}, {"id": "b2"}]
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("chunk_size", [1, 2, 5, 7, 13, 64, 4096])
+    async def test_streamed_response_split_across_chunks(self, mock_credentials, chunk_size):
+        """
+        Test Case 5: Batch response streamed in small chunks
+        
+        This test verifies that multipart delimiters split across chunk boundaries are
+        still found, and that messages come back in request order.
+        """
+        ids = [f"msg_{i}" for i in range(12)]
+        headers, body = batch_response(
+            [{"id": message_id, "snippet": "x" * i} for i, message_id in enumerate(ids)]
+        )
+        
+        def handler(request):
+            return httpx.Response(200, headers=headers, stream=ChunkedStream(body, chunk_size))
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            messages = await client.get_messages_batch(session, ids)
+        
+        assert [message["id"] for message in messages] == ids
+        assert [message["snippet"] for message in messages] == ["x" * i for i in range(12)]
+    
+    @pytest.mark.asyncio
+    async def test_batch_size_limit(self, mock_credentials):
+        """
+        Test Case 6: Batch size limits
+        
+        This test verifies that empty batches make no request and oversized ones are rejected.
+        """
+        def handler(request):
+            raise AssertionError("no request expected")
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            assert await client.get_messages_batch(session, []) == []
+            with pytest.raises(ValueError):
+                await client.get_messages_batch(session, [f"m{i}" for i in range(101)])
+
+
+class RefreshableCredentials(MockCredentials):
+    """Credentials whose refresh swaps in a new token, recording where it ran"""
+    
+    def __init__(self, token="expired_token"):
+        super().__init__(token)
+        self.refresh_token = "refresh_token"
+        self.refresh_threads = []
+    
+    def refresh(self, request):
+        self.refresh_threads.append(threading.current_thread())
+        time.sleep(0.05)  # Slow enough for concurrent 401s to overlap
+        self.token = "fresh_token"
+
+
+class TestBearerAuth:
+    """Test attaching and refreshing the OAuth token on the shared client"""
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_401s_refresh_once_and_retry(self):
+        """
+        Test Case 1: Expired token on concurrent requests
+        
+        This test verifies that concurrent 401 responses trigger a single refresh in a
+        worker thread, and that every request is retried with the new token.
+        """
+        credentials = RefreshableCredentials()
+        seen = []
+        
+        def handler(request):
+            seen.append((request.url.path, request.headers["Authorization"]))
+            if request.headers["Authorization"] != "Bearer fresh_token":
+                return httpx.Response(401)
+            return httpx.Response(200, json={"path": request.url.path})
+        
+        transport = httpx.MockTransport(handler)
+        async with httpx.AsyncClient(transport=transport, auth=BearerAuth(credentials)) as session:
+            responses = await asyncio.gather(
+                *[session.get(f"https://gmail.googleapis.com/{path}") for path in ("labels", "profile", "messages")]
+            )
+        
+        assert [response.status_code for response in responses] == [200, 200, 200]
+        assert len(credentials.refresh_threads) == 1
+        assert credentials.refresh_threads[0] is not threading.main_thread()
+        assert sorted(auth for _, auth in seen) == ["Bearer expired_token"] * 3 + ["Bearer fresh_token"] * 3
+    
+    @pytest.mark.asyncio
+    async def test_401_without_refresh_token_is_returned(self):
+        """
+        Test Case 2: Expired token that cannot be refreshed
+        
+        This test verifies that the 401 response is returned unchanged.
+        """
+        credentials = MockCredentials("expired_token")
+        credentials.refresh_token = None
+        transport = httpx.MockTransport(lambda request: httpx.Response(401))
+        async with httpx.AsyncClient(transport=transport, auth=BearerAuth(credentials)) as session:
+            response = await session.get("https://gmail.googleapis.com/profile")
+        
+        assert response.status_code == 401
+        assert response.request.headers["Authorization"] == "Bearer expired_token"
+
+
+class TestResponseCache:
+    """Test ETag revalidation of the on-disk labels/profile caches"""
+    
+    @pytest.fixture
+    def labels_cache(self, tmp_path):
+        return tmp_path / "labels.json"
+    
+    @pytest.mark.asyncio
+    async def test_etag_is_sent_and_304_uses_cache(self, mock_credentials, labels_cache):
+        """
+        Test Case 1: Revalidating a cached response
+        
+        This test verifies that the first response is stored with its ETag, that the ETag
+        is sent back as If-None-Match, and that a 304 returns the cached labels.
+        """
+        labels = [{"id": "INBOX", "name": "INBOX", "type": "system"}]
+        sent_etags = []
+        
+        def handler(request):
+            sent_etags.append(request.headers.get("If-None-Match"))
+            if request.headers.get("If-None-Match") == '"labels-v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, headers={"ETag": '"labels-v1"'}, json={"labels": labels})
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            assert await client.get_labels(session) == labels
+            assert json.loads(labels_cache.read_text()) == {"etag": '"labels-v1"', "data": {"labels": labels}}
+            assert await client.get_labels(session) == labels
+        
+        assert sent_etags == [None, '"labels-v1"']
+    
+    @pytest.mark.asyncio
+    async def test_changed_resource_replaces_cache(self, mock_credentials, labels_cache):
+        """
+        Test Case 2: Cached ETag no longer matches
+        
+        This test verifies that a 200 response replaces the cached entry.
+        """
+        labels_cache.write_text(json.dumps({"etag": '"old"', "data": {"labels": [{"name": "OLD"}]}}))
+        new_labels = [{"id": "Label_1", "name": "NEW", "type": "user"}]
+        
+        def handler(request):
+            assert request.headers["If-None-Match"] == '"old"'
+            return httpx.Response(200, headers={"ETag": '"new"'}, json={"labels": new_labels})
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            assert await client.get_labels(session) == new_labels
+        
+        assert json.loads(labels_cache.read_text())["etag"] == '"new"'
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("contents", ["{not json", '{"etag": "\\"abc\\""}', '{"data": {}}', "[]", ""])
+    async def test_corrupt_cache_is_ignored(self, mock_credentials, labels_cache, contents):
+        """
+        Test Case 3: Corrupt or partial cache file
+        
+        This test verifies that an unusable cache file is not revalidated against
+        and is overwritten by the fresh response.
+        """
+        labels_cache.write_text(contents)
+        labels = [{"id": "INBOX", "name": "INBOX", "type": "system"}]
+        
+        def handler(request):
+            assert "If-None-Match" not in request.headers
+            return httpx.Response(200, headers={"ETag": '"fresh"'}, json={"labels": labels})
+        
+        client = AsyncGmailClient(mock_credentials)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            assert await client.get_labels(session) == labels
+        
+        assert json.loads(labels_cache.read_text())["etag"] == '"fresh"'
+
+
+class TestMessageCache:
+    """Test the in-process cache of parsed messages"""
+    
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(agent.time, "monotonic", lambda: now[0])
+        return now
+    
+    def test_entries_expire_after_ttl(self, mock_credentials, clock):
+        """
+        Test Case 1: TTL expiry
+        
+        This test verifies that cached records are returned until MESSAGE_CACHE_TTL
+        seconds have passed, and not afterwards.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        client.cache_messages("me@example.com", [cached_record("m1")])
+        
+        clock[0] += MESSAGE_CACHE_TTL - 1
+        assert client.get_cached_messages("me@example.com", ["m1", "m2"]) == {"m1": cached_record("m1")}
+        clock[0] += 1
+        assert client.get_cached_messages("me@example.com", ["m1"]) == {}
+    
+    def test_expired_entries_are_evicted(self, mock_credentials, clock):
+        """
+        Test Case 2: Eviction
+        
+        This test verifies that storing new records removes expired ones.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        client.cache_messages("me@example.com", [cached_record("old")])
+        clock[0] += MESSAGE_CACHE_TTL
+        client.cache_messages("me@example.com", [cached_record("new")])
+        
+        assert set(AsyncGmailClient._msg_cache) == {("me@example.com", "new")}
+    
+    def test_accounts_do_not_share_records(self, mock_credentials, clock):
+        """
+        Test Case 3: Several accounts in one process
+        
+        This test verifies that a record cached for one account is invisible to another.
+        """
+        client = AsyncGmailClient(mock_credentials)
+        client.cache_messages("alice@example.com", [cached_record("m1")])
+        
+        assert client.get_cached_messages("bob@example.com", ["m1"]) == {}
+        assert AsyncGmailClient(MockCredentials("other")).get_cached_messages("alice@example.com", ["m1"])
+    
+    @pytest.mark.asyncio
+    async def test_only_uncached_ids_are_fetched(self, mock_credentials):
+        """
+        Test Case 4: Partially cached message list
+        
+        This test verifies that fetch_gmail_data_async only batches the IDs missing from
+        the account's cache, and returns records in message list order.
+        """
+        message_ids = [f"m{i}" for i in range(6)]
+        gmail = FakeGmail(message_ids)
+        client = AsyncGmailClient(mock_credentials)
+        client.cache_messages("me@example.com", [cached_record("m1"), cached_record("m4")])
+        client.cache_messages("someone.else@example.com", [cached_record("m2")])
+        
+        async with httpx.AsyncClient(transport=httpx.MockTransport(gmail)) as session:
+            data = await fetch_gmail_data_async(mock_credentials, session)
+            assert gmail.batches == [["m0", "m2", "m3", "m5"]]
+            
+            # A second poll is served entirely from the cache
+            again = await fetch_gmail_data_async(mock_credentials, session)
+            assert len(gmail.batches) == 1
+        
+        assert [email.messageId for email in data["emails"]] == message_ids
+        assert [email.threadId for email in data["emails"]] == [
+            "thread_m0", "from_cache", "thread_m2", "thread_m3", "from_cache", "thread_m5"
+        ]
+        assert again["emails"] == data["emails"]
+    
+    @pytest.mark.asyncio
+    async def test_out_of_order_batches_keep_list_order(self, mock_credentials):
+        """
+        Test Case 5: Cached and fetched records across several batches
+        
+        This test verifies that records are slotted back by message ID when the batches
+        complete out of order and a failed subrequest is retried outside its batch.
+        """
+        message_ids = [f"m{i}" for i in range(250)]
+        cached_ids = message_ids[::3]
+        gmail = FakeGmail(message_ids, missing={"m100"})
+        
+        async def handler(request):
+            # Hold back the first batch so the later ones are parsed before it
+            if str(request.url) == BATCH_URL and "messages/m1?" in request.content.decode():
+                await asyncio.sleep(0.05)
+            return gmail(request)
+        
+        client = AsyncGmailClient(mock_credentials)
+        client.cache_messages("me@example.com", [cached_record(message_id) for message_id in cached_ids])
+        
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            data = await fetch_gmail_data_async(mock_credentials, session)
+        
+        # Batches are recorded as they are served: the second one finished first
+        assert [len(batch) for batch in gmail.batches] == [66, 100]
+        assert gmail.batches[-1][0] == "m1"
+        assert gmail.singles == ["m100"]
+        assert [email.messageId for email in data["emails"]] == message_ids
+        for email in data["emails"]:
+            assert (email.threadId == "from_cache") == (email.messageId in cached_ids)
+    
+    @pytest.mark.asyncio
+    async def test_failed_message_raises_and_cancels_batches(self, mock_credentials):
+        """
+        Test Case 6: A message that cannot be fetched at all
+        
+        This test verifies that the 404 from the individual retry propagates out of
+        fetch_gmail_data_async and that the batch still in flight is cancelled.
+        """
+        message_ids = [f"m{i}" for i in range(150)]
+        gmail = FakeGmail(message_ids, deleted={"m120"})
+        slow_batch_cancelled = asyncio.Event()
+        
+        async def handler(request):
+            # The first batch never completes on its own
+            if str(request.url) == BATCH_URL and "messages/m0?" in request.content.decode():
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    slow_batch_cancelled.set()
+                    raise
+            return gmail(request)
+        
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as session:
+            with pytest.raises(httpx.HTTPStatusError) as excinfo:
+                await fetch_gmail_data_async(mock_credentials, session)
+            await asyncio.wait_for(slow_batch_cancelled.wait(), 1)
+        
+        assert excinfo.value.response.status_code == 404
+        assert AsyncGmailClient._msg_cache == {}
 
 
 if __name__ == "__main__":